@@ -1,5 +1,7 @@
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.datastructures import Headers
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
@@ -7,14 +9,17 @@ import uvicorn
 import json
 import tempfile
 import os
-import subprocess
 from fastapi import File, UploadFile
 from pydub import AudioSegment
 import openai
-import base64
+import httpx
+import pybase64
 import io
+import asyncio
+import hashlib
+from cachetools import LRUCache
 
-from assistant import AIAssistant
+from assistant import AIAssistant, STREAM_RESET
 from models import Appointment
 
 AudioSegment.converter = "/opt/homebrew/bin/ffmpeg"
@@ -23,10 +28,48 @@ AudioSegment.converter = "/opt/homebrew/bin/ffmpeg"
 app = FastAPI(
     title="Health Assistant API",
     description="API for interacting with the AI Health Assistant",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# Configure CORS
+# Reject oversize uploads before the body is read (25 MB matches the Whisper file limit)
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class LimitUploadSizeMiddleware:
+    """Reject request bodies over MAX_UPLOAD_BYTES, whether or not they declare a Content-Length"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Fast path: a declared Content-Length can be rejected before any of the body is read
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            response = ORJSONResponse(status_code=413, content={"detail": "Uploaded file is too large"})
+            return await response(scope, receive, send)
+
+        # Chunked uploads carry no Content-Length, so count the body as it arrives instead
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BYTES:
+                    # Raised while FastAPI parses the body, which re-raises HTTPExceptions as-is
+                    raise HTTPException(status_code=413, detail="Uploaded file is too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(LimitUploadSizeMiddleware)
+
+# Configure CORS (added last so it also wraps the upload size check)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -41,7 +84,17 @@ assistant = AIAssistant()
 # Initialize OpenAI client
 # Note: Set your API key as an environment variable or replace with your actual key
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "your_api_key_here")
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# One pooled HTTP client so concurrent requests reuse keep-alive connections to the OpenAI API
+openai_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=60.0
+)
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=openai_http_client)
+
+# Whisper transcripts keyed by a hash of the uploaded audio bytes
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", 1024))
+transcript_cache = LRUCache(maxsize=TRANSCRIPT_CACHE_SIZE)
+transcript_locks = {}  # audio hash -> [asyncio.Lock, requests using it], so concurrent identical uploads transcribe once
 
 # Pydantic models for request/response validation
 class ChatRequest(BaseModel):
@@ -66,7 +119,7 @@ class AppointmentUpdate(BaseModel):
 class AppointmentResponse(BaseModel):
     id: str
     user_id: str
-    date_time: str
+    date_time: datetime
     purpose: str
     status: str
     email: Optional[str] = None
@@ -77,16 +130,31 @@ class VoiceRequest(BaseModel):
 
 # API endpoints
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
     """Process a chat message using the AI assistant"""
     try:
-        response = assistant.process_query(request.message, request.user_id)
+        response = await asyncio.to_thread(assistant.process_query, request.message, request.user_id, background_tasks)
         return ChatResponse(response=response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks):
+    """Process a chat message, streaming the reply as Server-Sent Events"""
+    async def event_source():
+        try:
+            async for token in assistant.stream_query(request.message, request.user_id, background_tasks):
+                yield sse_event("", event="reset") if token is STREAM_RESET else sse_event(token)
+        except Exception as e:
+            yield sse_event(f"Error processing message: {str(e)}", event="error")
+            return
+        yield sse_event("", event="done")
+
+    return StreamingResponse(event_source(), media_type="text/event-stream")
+
+# The appointment handlers are plain functions so FastAPI runs their (possibly database-backed) store calls in its threadpool
 @app.post("/appointments", response_model=AppointmentResponse)
-async def create_appointment(appointment: AppointmentCreate):
+def create_appointment(appointment: AppointmentCreate):
     """Create a new appointment"""
     try:
         date_time = datetime.fromisoformat(appointment.date_time)
@@ -99,7 +167,7 @@ async def create_appointment(appointment: AppointmentCreate):
         return AppointmentResponse(
             id=new_appointment.id,
             user_id=new_appointment.user_id,
-            date_time=new_appointment.date_time.isoformat(),
+            date_time=new_appointment.date_time,
             purpose=new_appointment.purpose,
             status=new_appointment.status,
             email=new_appointment.email
@@ -108,7 +176,7 @@ async def create_appointment(appointment: AppointmentCreate):
         raise HTTPException(status_code=400, detail=f"Error creating appointment: {str(e)}")
 
 @app.get("/appointments/{user_id}", response_model=List[AppointmentResponse])
-async def get_appointments(user_id: str):
+def get_appointments(user_id: str):
     """Get all appointments for a user"""
     try:
         appointments = assistant.health_assistant.get_appointments(user_id)
@@ -116,7 +184,7 @@ async def get_appointments(user_id: str):
             AppointmentResponse(
                 id=appt.id,
                 user_id=appt.user_id,
-                date_time=appt.date_time.isoformat(),
+                date_time=appt.date_time,
                 purpose=appt.purpose,
                 status=appt.status,
                 email=appt.email
@@ -126,7 +194,7 @@ async def get_appointments(user_id: str):
         raise HTTPException(status_code=500, detail=f"Error retrieving appointments: {str(e)}")
 
 @app.put("/appointments/{appointment_id}", response_model=AppointmentResponse)
-async def update_appointment(appointment_id: str, update_data: AppointmentUpdate):
+def update_appointment(appointment_id: str, update_data: AppointmentUpdate):
     """Update an existing appointment"""
     try:
         update_dict = {}
@@ -144,7 +212,7 @@ async def update_appointment(appointment_id: str, update_data: AppointmentUpdate
         return AppointmentResponse(
             id=updated.id,
             user_id=updated.user_id,
-            date_time=updated.date_time.isoformat(),
+            date_time=updated.date_time,
             purpose=updated.purpose,
             status=updated.status,
             email=updated.email
@@ -155,7 +223,7 @@ async def update_appointment(appointment_id: str, update_data: AppointmentUpdate
         raise HTTPException(status_code=400, detail=f"Error updating appointment: {str(e)}")
 
 @app.delete("/appointments/{appointment_id}", response_model=dict)
-async def delete_appointment(appointment_id: str, reason: str = "User requested cancellation"):
+def delete_appointment(appointment_id: str, reason: str = "User requested cancellation"):
     """Delete an appointment"""
     try:
         # First get the appointment to ensure it exists
@@ -177,6 +245,88 @@ async def delete_appointment(appointment_id: str, reason: str = "User requested
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting appointment: {str(e)}")
     
+async def convert_audio(input_path: str, upload: Optional[UploadFile] = None) -> bytes:
+    """Convert audio to mp3 with FFmpeg, reading from input_path or, for "pipe:0", from the upload"""
+    ffmpeg_command = [
+        "ffmpeg",
+        "-i", input_path,
+        "-ac", "1",  # Mono channel
+        "-ar", "16000",  # 16kHz sample rate (Whisper resamples to 16kHz anyway)
+        "-f", "mp3",  # OpenAI prefers mp3
+        "-hide_banner",
+        "-loglevel", "error",
+        "pipe:1"  # Write the converted audio to stdout
+    ]
+    
+    process = await asyncio.create_subprocess_exec(
+        *ffmpeg_command,
+        stdin=asyncio.subprocess.PIPE if upload is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=1024 * 1024
+    )
+
+    async def feed_stdin():
+        # Stream the upload in chunks so the raw audio is never held in memory all at once
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # FFmpeg exited early; its stderr explains why
+        finally:
+            process.stdin.close()
+
+    readers = [process.stdout.read(), process.stderr.read()]
+    if upload is not None:
+        readers.append(feed_stdin())
+    converted_audio, stderr, *_ = await asyncio.gather(*readers)
+    await process.wait()
+    
+    if process.returncode != 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Audio conversion failed: {stderr.decode(errors='replace')}"
+        )
+    return converted_audio
+
+async def transcribe_audio(upload: UploadFile) -> str:
+    """Convert uploaded audio to mp3 with FFmpeg and transcribe it with OpenAI Whisper"""
+    # Convert the audio to mp3 format for OpenAI, piping bytes through FFmpeg instead of temp files.
+    # MP4-family containers (m4a/mov, common from phones and Safari) may keep their index at the end
+    # of the file, which FFmpeg can't seek to on a pipe, so those are spooled to a temp file instead
+    header = await upload.read(12)
+    await upload.seek(0)
+    if header[4:8] == b"ftyp":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, "input")
+            with open(input_path, "wb") as f:
+                while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            converted_audio = await convert_audio(input_path)
+    else:
+        converted_audio = await convert_audio("pipe:0", upload)
+
+    # Verify the conversion produced audio
+    if not converted_audio:
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to create converted audio file"
+        )
+
+    # Use OpenAI to transcribe the audio without blocking the event loop
+    try:
+        transcript = await openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("audio.mp3", converted_audio, "audio/mpeg")
+        )
+        return transcript.text
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, 
+            detail=f"OpenAI transcription error: {str(e)}"
+        )
+
 @app.post("/voice-to-text", response_model=ChatResponse)
 async def voice_to_text(
     user_id: str, 
@@ -184,80 +334,34 @@ async def voice_to_text(
     background_tasks: BackgroundTasks = None
 ):
     """Process voice input using OpenAI and convert to text for chat processing"""
-    temp_input_path = None
-    temp_path = None
     try:
-        # Read the uploaded file content
-        file_content = await audio_file.read()
-        if not file_content:
+        # Hash the upload in chunks; identical uploads share one transcript, so only the first pays for FFmpeg + Whisper
+        hasher = hashlib.blake2b(digest_size=16)
+        file_size = 0
+        while chunk := await audio_file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            file_size += len(chunk)
+        if not file_size:
             raise HTTPException(status_code=400, detail="Uploaded file is empty")
 
-        # Determine the input format from the filename
-        input_format = audio_file.filename.split(".")[-1].lower()
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            temp_input_path = os.path.join(tmp_dir, f"input.{input_format}")
-            temp_path = os.path.join(tmp_dir, "audio.mp3")  # OpenAI prefers mp3
-
-            # Save the uploaded content to the temporary input file
-            with open(temp_input_path, "wb") as f:
-                f.write(file_content)
-
-            # Convert the audio to mp3 format for OpenAI
-            try:
-                ffmpeg_command = [
-                    "ffmpeg",
-                    "-y",  # Overwrite output file if it exists
-                    "-i", temp_input_path,
-                    "-ac", "1",  # Mono channel
-                    "-ar", "44100",  # 44.1kHz sample rate (good for OpenAI)
-                    "-hide_banner",
-                    "-loglevel", "error",
-                    temp_path
-                ]
-                
-                result = subprocess.run(
-                    ffmpeg_command,
-                    check=True,
-                    capture_output=True,
-                    text=True
-                )
-                
-                if result.returncode != 0:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"FFmpeg conversion failed: {result.stderr}"
-                    )
-                    
-            except subprocess.CalledProcessError as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Audio conversion failed: {e.stderr}"
-                )
-
-            # Verify the converted file exists
-            if not os.path.exists(temp_path):
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to create converted audio file"
-                )
-
-            # Use OpenAI to transcribe the audio
-            try:
-                with open(temp_path, "rb") as audio_file:
-                    transcript = openai_client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file
-                    )
-                text = transcript.text
-            except Exception as e:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"OpenAI transcription error: {str(e)}"
-                )
+        audio_hash = hasher.hexdigest()
+        entry = transcript_locks.setdefault(audio_hash, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                text = transcript_cache.get(audio_hash)
+                if text is None:
+                    await audio_file.seek(0)
+                    text = await transcribe_audio(audio_file)
+                    transcript_cache[audio_hash] = text
+        finally:
+            # Drop the lock only once no request holds or waits on it (locked() clears before waiters wake)
+            entry[1] -= 1
+            if not entry[1]:
+                del transcript_locks[audio_hash]
 
         # Process the transcribed text through the AI assistant
-        response = assistant.process_query(text, user_id)
+        response = await asyncio.to_thread(assistant.process_query, text, user_id, background_tasks)
         return ChatResponse(
             response=response,
             transcribed_text=text
@@ -265,14 +369,6 @@ async def voice_to_text(
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
-    finally:
-        # Cleanup temporary files
-        for path in [temp_input_path, temp_path]:
-            if path and os.path.exists(path):
-                try:
-                    os.remove(path)
-                except:
-                    pass
 
 
 class ImageAnalysisRequest(BaseModel):
@@ -289,6 +385,57 @@ class ImageAnalysisRequest(BaseModel):
 class ImageAnalysisResponse(BaseModel):
     analysis: str
 
+def build_image_messages(file_content: bytes, filename: str, prompt: str) -> list:
+    """Build the OpenAI vision payload for an uploaded image"""
+    # Encode image to base64 (pybase64 uses SIMD and returns the str directly, skipping a decode copy)
+    encoded_image = pybase64.b64encode_as_string(file_content)
+    
+    # Determine mime type based on file extension
+    file_extension = filename.split(".")[-1].lower()
+    mime_type = f"image/{file_extension}"
+    if file_extension == "jpg" or file_extension == "jpeg":
+        mime_type = "image/jpeg"
+    elif file_extension == "png":
+        mime_type = "image/png"
+    elif file_extension == "webp":
+        mime_type = "image/webp"
+    
+    # Create message payload with system prompt, user text, and image
+    return [
+        {
+            "role": "system", 
+            "content": "You are a medical assistant who can analyze medical images. "
+                       "Provide accurate, professional analysis of medical imagery. "
+                       "Always note when findings are uncertain and recommend professional "
+                       "medical consultation for definitive diagnosis."
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
+            ],
+        }
+    ]
+
+def save_image_analysis(user_id: str, prompt: str, analysis: str):
+    """Save the conversation with context about the image"""
+    assistant.health_assistant.save_conversation(
+        user_id, 
+        "user", 
+        f"[Uploaded an image with prompt: {prompt}]"
+    )
+    assistant.health_assistant.save_conversation(
+        user_id, 
+        "assistant", 
+        f"[Image analysis]: {analysis}"
+    )
+
+def sse_event(data: str, event: Optional[str] = None) -> str:
+    """Format a Server-Sent Event; data is JSON-encoded so newlines in tokens survive framing"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
 @app.post("/analyze-image", response_model=ImageAnalysisResponse)
 async def analyze_image(
     user_id: str,
@@ -302,39 +449,10 @@ async def analyze_image(
         if not file_content:
             raise HTTPException(status_code=400, detail="Uploaded file is empty")
             
-        # Encode image to base64
-        encoded_image = base64.b64encode(file_content).decode("utf-8")
-        
-        # Determine mime type based on file extension
-        file_extension = image_file.filename.split(".")[-1].lower()
-        mime_type = f"image/{file_extension}"
-        if file_extension == "jpg" or file_extension == "jpeg":
-            mime_type = "image/jpeg"
-        elif file_extension == "png":
-            mime_type = "image/png"
-        elif file_extension == "webp":
-            mime_type = "image/webp"
-        
-        # Create message payload with system prompt, user text, and image
-        messages = [
-            {
-                "role": "system", 
-                "content": "You are a medical assistant who can analyze medical images. "
-                           "Provide accurate, professional analysis of medical imagery. "
-                           "Always note when findings are uncertain and recommend professional "
-                           "medical consultation for definitive diagnosis."
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
-                ],
-            }
-        ]
+        messages = build_image_messages(file_content, image_file.filename, prompt)
         
         # Make API request to OpenAI
-        completion = openai_client.chat.completions.create(
+        completion = await openai_client.chat.completions.create(
             model="gpt-4-turbo",  # Use the vision-enabled model
             messages=messages,
             max_tokens=500
@@ -342,25 +460,51 @@ async def analyze_image(
         
         # Extract analysis from response
         analysis = completion.choices[0].message.content
-
         
-        # Save the conversation with context about the image
-        assistant.health_assistant.save_conversation(
-            user_id, 
-            "user", 
-            f"[Uploaded an image with prompt: {prompt}]"
-        )
-        assistant.health_assistant.save_conversation(
-            user_id, 
-            "assistant", 
-            f"[Image analysis]: {analysis}"
-        )
+        await asyncio.to_thread(save_image_analysis, user_id, prompt, analysis)
         
         return ImageAnalysisResponse(analysis=analysis)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image analysis error: {str(e)}")
 
+@app.post("/analyze-image/stream")
+async def analyze_image_stream(
+    user_id: str,
+    prompt: str = "What do you see in this medical image?",
+    image_file: UploadFile = File(...)
+):
+    """Analyze a medical image, streaming the analysis as Server-Sent Events"""
+    try:
+        file_content = await image_file.read()
+        if not file_content:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+            
+        messages = build_image_messages(file_content, image_file.filename, prompt)
+        completion_stream = await openai_client.chat.completions.create(
+            model="gpt-4-turbo",  # Use the vision-enabled model
+            messages=messages,
+            max_tokens=500,
+            stream=True
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Image analysis error: {str(e)}")
+
+    async def event_source():
+        chunks = []
+        try:
+            async for chunk in completion_stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+                    yield sse_event(chunk.choices[0].delta.content)
+        except Exception as e:
+            yield sse_event(f"Image analysis error: {str(e)}", event="error")
+            return
+        await asyncio.to_thread(save_image_analysis, user_id, prompt, "".join(chunks))
+        yield sse_event("", event="done")
+
+    return StreamingResponse(event_source(), media_type="text/event-stream")
+
 # Run the application
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
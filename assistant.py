@@ -1,19 +1,39 @@
 from langchain.agents import AgentExecutor
 from langchain.tools import StructuredTool
 from langchain.agents import create_openai_tools_agent
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage  # Import message classes
-from models import HealthAssistant, Appointment
+from models import create_health_assistant, Appointment
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-from utils import parse_natural_date, send_email
+from utils import parse_natural_date, send_email, enqueue_email, is_valid_email
 from pydantic import BaseModel, Field
 import re
+import asyncio
+import numpy as np
+from contextvars import ContextVar
 
 load_dotenv()
 
+# Semantic response cache: reuse an answer when a new query embeds close enough to a previous one
+SEMANTIC_CACHE_ENABLED = os.getenv("ALLOW_SEMANTIC_CACHE", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 256  # per user
+# Appointment queries depend on live data and mutations must always reach the agent
+_UNCACHEABLE_RE = re.compile(r'(?i)appointment|book|cancel|delete|update|schedule|create')
+
+# process_query runs in worker threads, so the active user is tracked per request rather than on the instance
+_current_user_id = ContextVar("current_user_id", default=None)
+# FastAPI BackgroundTasks for the current request, used to send emails after the response is returned
+_current_background_tasks = ContextVar("current_background_tasks", default=None)
+
+# Yielded by stream_query when text already streamed turns out to precede a tool call and should be discarded
+STREAM_RESET = object()
+
+# Queries that may carry a date worth parsing; matched case-insensitively without lowercasing a copy
+_INTENT_RE = re.compile(r'appointment|schedule|book', re.IGNORECASE)
+
 class CreateAppointmentInput(BaseModel):
     date_time: str = Field(..., description="Appointment datetime in ISO format")
     purpose: str = Field(..., description="Purpose of the appointment")
@@ -35,12 +55,22 @@ class ListAppointmentsInput(BaseModel):
 
 class AIAssistant:
     def __init__(self):
-        self.health_assistant = HealthAssistant()
+        self.health_assistant = create_health_assistant()
         self.llm = ChatOpenAI(model="gpt-4-turbo", temperature=0)
         self.current_user_id = None  # Kept for compatibility, but we'll use self.user_id
         self.tools = self._setup_tools()
         self.agent = self._setup_agent()
+        self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small") if SEMANTIC_CACHE_ENABLED else None
+        self.embed_cache = {}  # user_id -> (matrix of unit-norm query embeddings, cached responses, their contexts)
     
+    @property
+    def user_id(self):
+        return _current_user_id.get()
+
+    @user_id.setter
+    def user_id(self, value):
+        _current_user_id.set(value)
+
     def _setup_tools(self):
         return [
             StructuredTool.from_function(
@@ -91,11 +121,21 @@ class AIAssistant:
             ("human", "{input}"),
             MessagesPlaceholder("agent_scratchpad")
         ]) 
-        return AgentExecutor(agent=create_openai_tools_agent(self.llm, self.tools, prompt), tools=self.tools)
+        return AgentExecutor(
+            agent=create_openai_tools_agent(self.llm, self.tools, prompt),
+            tools=self.tools,
+            return_intermediate_steps=True,  # Lets the semantic cache skip runs that called a tool
+        )
 
     def _validate_email(self, email: str) -> bool:
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        return bool(re.match(email_pattern, email))
+        return is_valid_email(email)
+
+    def _send_email(self, to_email: str, subject: str, body: str):
+        background_tasks = _current_background_tasks.get()
+        if background_tasks is not None:
+            background_tasks.add_task(send_email, to_email=to_email, subject=subject, body=body)
+        else:
+            enqueue_email(to_email=to_email, subject=subject, body=body)
 
     def _create_appointment_wrapper(self, date_time: str, purpose: str, email: str) -> str:
         try:
@@ -121,18 +161,17 @@ class AIAssistant:
             Thank you,
             Health Assistant Team
             """
-            send_email(to_email=email, subject=email_subject, body=email_body)
+            self._send_email(to_email=email, subject=email_subject, body=email_body)
             return f"Appointment created: {dt.strftime('%Y-%m-%d %H:%M')} - {purpose} (ID: {appointment.id}). Confirmation email sent to {email}."
         except Exception as e:
             return f"Error creating appointment: {str(e)}"
 
     def _update_appointment_wrapper(self, appointment_id: str, date_time: str = None, purpose: str = None, email: str = None) -> str:
         try:
-            existing_appointment = self.health_assistant.get_appointment(appointment_id)
-            if not existing_appointment:
-                return "Appointment not found"
-            # Optional: Check ownership
-            if existing_appointment.user_id != self.user_id:
+            # Ownership check first; the appointment itself is only fetched to explain a failure
+            if not self.health_assistant.is_owner(self.user_id, appointment_id):
+                if not self.health_assistant.get_appointment(appointment_id):
+                    return "Appointment not found"
                 return "You don't have permission to update this appointment."
             update_data = {}
             if date_time:
@@ -145,9 +184,9 @@ class AIAssistant:
                 update_data["email"] = email
             updated = self.health_assistant.update_appointment(appointment_id, **update_data)
             if updated:
-                notification_email = email or getattr(existing_appointment, 'email', None)
+                notification_email = email or updated.email
                 if notification_email:
-                    updated_appointment = self.health_assistant.get_appointment(appointment_id)
+                    updated_appointment = updated
                     email_subject = "Appointment Update Notification"
                     email_body = f"""
                     Dear Patient,
@@ -160,7 +199,7 @@ class AIAssistant:
                     Thank you,
                     Health Assistant Team
                     """
-                    send_email(to_email=notification_email, subject=email_subject, body=email_body)
+                    self._send_email(to_email=notification_email, subject=email_subject, body=email_body)
                     return f"Updated appointment {appointment_id}. Update notification sent to {notification_email}."
                 return f"Updated appointment {appointment_id}"
             else:
@@ -198,7 +237,7 @@ class AIAssistant:
                     Thank you,
                     Health Assistant Team
                     """
-                    send_email(to_email=email, subject=email_subject, body=email_body)
+                    self._send_email(to_email=email, subject=email_subject, body=email_body)
                     return f"Appointment cancelled: {appt_date} - {appointment.purpose}\nReason: {reason}\nCancellation notification sent to {email}."
                 return f"Appointment cancelled: {appt_date} - {appointment.purpose}\nReason: {reason}"
             else:
@@ -206,33 +245,132 @@ class AIAssistant:
         except Exception as e:
             return f"Error deleting appointment: {str(e)}"
 
-    def process_query(self, user_input: str, user_id: str) -> str:
+    def _normalize(self, embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / np.linalg.norm(embedding)
+
+    def _embed_query(self, text: str) -> np.ndarray:
+        return self._normalize(self.embeddings.embed_query(text))
+
+    async def _aembed_query(self, text: str) -> np.ndarray:
+        return self._normalize(await self.embeddings.aembed_query(text))
+
+    def _cache_context(self, chat_history: list) -> str:
+        # Follow-ups ("yes", "why?") only mean the same thing after the same assistant turn
+        return next((message.content for message in reversed(chat_history) if message.type == "ai"), "")
+
+    def _semantic_cache_lookup(self, user_id: str, embedding: np.ndarray, context: str):
+        entry = self.embed_cache.get(user_id)
+        if entry is None:
+            return None
+        matrix, responses, contexts = entry
+        sims = matrix @ embedding  # rows are unit-norm, so this is cosine similarity
+        sims[[i for i, cached_context in enumerate(contexts) if cached_context != context]] = -1.0
+        best = int(sims.argmax())
+        return responses[best] if sims[best] > SEMANTIC_CACHE_THRESHOLD else None
+
+    def _semantic_cache_store(self, user_id: str, embedding: np.ndarray, response: str, context: str):
+        matrix, responses, contexts = self.embed_cache.get(
+            user_id, (np.empty((0, embedding.shape[0]), dtype=np.float32), [], [])
+        )
+        matrix = np.vstack([matrix, embedding])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+        responses = (responses + [response])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+        contexts = (contexts + [context])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+        self.embed_cache[user_id] = (matrix, responses, contexts)
+
+    def _start_query(self, user_id: str, background_tasks) -> str:
         user_id = self.current_user_id or user_id
+        self.user_id = user_id  # Set user_id for tools to access
+        _current_background_tasks.set(background_tasks)
+        return user_id
+
+    def _is_cacheable(self, user_input: str) -> bool:
+        return self.embeddings is not None and not _UNCACHEABLE_RE.search(user_input)
+
+    def _build_context(self, user_input: str, user_id: str, chat_history: list) -> dict:
         parsed_date = None
-        if any(keyword in user_input.lower() for keyword in ["appointment", "schedule", "book"]):
+        if _INTENT_RE.search(user_input):
             try:
                 parsed_date = parse_natural_date(user_input)
             except:
                 pass
-        self.user_id = user_id  # Set user_id for tools to access
-        # Convert conversation history to message objects
-        chat_history = self.health_assistant.conversation_history.get(user_id, [])
-        chat_history_messages = [
-            HumanMessage(content=msg) if role == "user" else AIMessage(content=msg)
-            for role, msg in chat_history
-        ]
         context = {
             "input": user_input,
             "user_id": user_id,
             "current_date": datetime.now().isoformat(),
-            "chat_history": chat_history_messages  # Pass formatted messages
+            "chat_history": chat_history  # Pass formatted messages
         }
         if parsed_date:
             context["detected_date"] = parsed_date.isoformat()
-        response = self.agent.invoke(context)
+        return context
+
+    def _record_exchange(self, user_id: str, user_input: str, output: str, query_embedding=None, cache_context=""):
         self.health_assistant.save_conversation(user_id, "user", user_input)
-        self.health_assistant.save_conversation(user_id, "assistant", response["output"])
+        self.health_assistant.save_conversation(user_id, "assistant", output)
+        if query_embedding is not None:
+            self._semantic_cache_store(user_id, query_embedding, output, cache_context)
+
+    def process_query(self, user_input: str, user_id: str, background_tasks=None) -> str:
+        user_id = self._start_query(user_id, background_tasks)
+        chat_history = self.health_assistant.get_conversation(user_id)
+        query_embedding = None
+        cache_context = self._cache_context(chat_history)
+        if self._is_cacheable(user_input):
+            query_embedding = self._embed_query(user_input)
+            cached = self._semantic_cache_lookup(user_id, query_embedding, cache_context)
+            if cached is not None:
+                self._record_exchange(user_id, user_input, cached)
+                return cached
+        response = self.agent.invoke(self._build_context(user_input, user_id, chat_history))
+        if response["intermediate_steps"]:
+            query_embedding = None  # A tool ran (and may have changed data); replaying the answer would skip it
+        self._record_exchange(user_id, user_input, response["output"], query_embedding, cache_context)
         return response["output"]
+
+    async def stream_query(self, user_input: str, user_id: str, background_tasks=None):
+        """Like process_query, but yields the answer token by token as the model produces it (or STREAM_RESET)"""
+        user_id = self._start_query(user_id, background_tasks)
+        chat_history = await asyncio.to_thread(self.health_assistant.get_conversation, user_id)
+        query_embedding = None
+        cache_context = self._cache_context(chat_history)
+        if self._is_cacheable(user_input):
+            query_embedding = await self._aembed_query(user_input)
+            cached = self._semantic_cache_lookup(user_id, query_embedding, cache_context)
+            if cached is not None:
+                await asyncio.to_thread(self._record_exchange, user_id, user_input, cached)
+                yield cached
+                return
+        context = await asyncio.to_thread(self._build_context, user_input, user_id, chat_history)
+        chunks = []
+        pending = {}  # run_id -> tokens streamed for an LLM call that may still turn out to be a tool call
+        tool_runs = set()  # run_ids already known to be tool calls; their text is dropped
+        async for event in self.agent.astream_events(context, version="v2"):
+            run_id = event["run_id"]
+            if event["event"] == "on_tool_start":
+                query_embedding = None  # Same rule as process_query: never cache a run that called a tool
+            elif event["event"] == "on_chat_model_stream":
+                if run_id in tool_runs:
+                    continue
+                chunk = event["data"]["chunk"]
+                if chunk.tool_call_chunks:
+                    # Text the model emitted before a tool call ("Let me check...") isn't part of the answer
+                    tool_runs.add(run_id)
+                    if pending.pop(run_id, None):
+                        yield STREAM_RESET
+                elif chunk.content:
+                    pending.setdefault(run_id, []).append(chunk.content)
+                    yield chunk.content
+            elif event["event"] == "on_chat_model_end":
+                tokens = pending.pop(run_id, [])
+                if run_id in tool_runs or event["data"]["output"].tool_calls:
+                    tool_runs.discard(run_id)
+                    if tokens:
+                        yield STREAM_RESET
+                else:
+                    chunks.extend(tokens)
+        await asyncio.to_thread(
+            self._record_exchange, user_id, user_input, "".join(chunks), query_embedding, cache_context
+        )
         
     def _list_appointments_wrapper(self, user_id: str) -> str:
         try:
@@ -240,12 +378,9 @@ class AIAssistant:
             appointments = self.health_assistant.get_appointments(user_id)
             if not appointments:
                 return "No appointments found"
-            formatted = []
-            for appt in appointments:
-                formatted.append(
-                    f"- {appt.date_time.strftime('%Y-%m-%d %H:%M')}: "
-                    f"{appt.purpose} (ID: {appt.id})"
-                )
-            return "Your appointments:\n" + "\n".join(formatted)
+            return "Your appointments:\n" + "\n".join(
+                f"- {appt.date_time:%Y-%m-%d %H:%M}: {appt.purpose} (ID: {appt.id})"
+                for appt in appointments
+            )
         except Exception as e:
             return f"Error retrieving appointments: {str(e)}"
@@ -0,0 +1,47 @@
+from sqlalchemy import create_engine, MetaData, Table, Column, Index, Integer, String, Text, DateTime
+from sqlalchemy.engine import Engine
+import os
+
+# Shared store for appointments and conversations; unset keeps everything in process memory
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+metadata = MetaData()
+
+appointments = Table(
+    "appointments",
+    metadata,
+    Column("id", String(36), primary_key=True),
+    Column("user_id", String(255), nullable=False, index=True),
+    Column("date_time", DateTime, nullable=False),
+    Column("purpose", Text, nullable=False),
+    Column("status", String(32), nullable=False),
+    Column("email", String(255)),
+)
+
+conversations = Table(
+    "conversations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", String(255), nullable=False),
+    Column("ts", DateTime, nullable=False),
+    Column("role", String(16), nullable=False),
+    Column("content", Text, nullable=False),
+    Index("ix_conversations_user_id_id", "user_id", "id"),
+)
+
+cancellations = Table(
+    "cancellations",
+    metadata,
+    Column("appointment_id", String(36), primary_key=True),
+    Column("reason", Text, nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+def create_db_engine(url: str) -> Engine:
+    """Create a pooled engine for the given database URL and make sure the tables exist"""
+    engine_options = {"pool_pre_ping": True}
+    if not url.startswith("sqlite"):
+        engine_options.update(pool_size=20, max_overflow=10)
+    engine = create_engine(url, **engine_options)
+    metadata.create_all(engine)
+    return engine
@@ -0,0 +1,10 @@
+import multiprocessing
+import os
+
+# Gunicorn settings for production: gunicorn app:app -c gunicorn_conf.py
+# Each worker process has its own AIAssistant, so set DATABASE_URL to share appointments and
+# conversation history between workers; the in-memory store only works with a single worker.
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 5
@@ -1,10 +1,21 @@
 from datetime import datetime
-from pydantic import BaseModel, Field
+from dataclasses import dataclass, field, asdict
 from typing import Dict, List, Optional
+from collections import deque
+from langchain_core.messages import HumanMessage, AIMessage
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.engine import Engine
+import db
+import os
 import uuid
 
-class Appointment(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+# Older turns are dropped so memory and prompt size stay bounded per user
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", 40))
+
+# Internal store record; the Pydantic models in app.py handle validation at the API boundary
+@dataclass(slots=True, kw_only=True)
+class Appointment:
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     date_time: datetime
     purpose: str
@@ -12,14 +23,7 @@ class Appointment(BaseModel):
     email: Optional[str] = None
     
     def to_dict(self):
-        return {
-            "id": self.id,
-            "user_id": self.user_id,
-            "date_time": self.date_time,
-            "purpose": self.purpose,
-            "status": self.status,
-            "email": self.email
-        }
+        return asdict(self)
     
     @classmethod
     def from_dict(cls, data):
@@ -32,31 +36,47 @@ class Appointment(BaseModel):
             email=data.get("email")
         )
 
+def _to_message(role: str, content: str):
+    return HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+
 class HealthAssistant:
     def __init__(self):
         self.appointments = {}
-        self.conversation_history = {}  # Changed to dictionary: user_id -> list of (role, content)
+        self.conversation_history = {}  # user_id -> deque of chat messages, capped at MAX_HISTORY_MESSAGES
         self.cancellations = {}
+        self.by_user = {}  # user_id -> appointment ids (dict keys keep creation order)
     
     def save_conversation(self, user_id: str, role: str, content: str):
         if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = []
-        self.conversation_history[user_id].append((role, content))
+            self.conversation_history[user_id] = deque(maxlen=MAX_HISTORY_MESSAGES)
+        # Stored as LangChain messages so the agent can consume history without converting it each turn
+        self.conversation_history[user_id].append(_to_message(role, content))
+
+    def get_conversation(self, user_id: str) -> List:
+        return list(self.conversation_history.get(user_id, ()))
         
     def create_appointment(self, user_id: str, date_time: datetime, purpose: str, email: str = None) -> Appointment:
         appointment = Appointment(user_id=user_id, date_time=date_time, purpose=purpose, email=email)
         self.appointments[appointment.id] = appointment
+        self.by_user.setdefault(user_id, {})[appointment.id] = None
         return appointment
 
     def get_appointment(self, appointment_id: str) -> Optional[Appointment]:
         return self.appointments.get(appointment_id)
 
+    def is_owner(self, user_id: str, appointment_id: str) -> bool:
+        return appointment_id in self.by_user.get(user_id, ())
+
     def update_appointment(self, appointment_id: str, **kwargs) -> Optional[Appointment]:
         appointment = self.appointments.get(appointment_id)
         if not appointment:
             return None
+        previous_user_id = appointment.user_id
         for key, value in kwargs.items():
             setattr(appointment, key, value)
+        if appointment.user_id != previous_user_id:
+            self.by_user.get(previous_user_id, {}).pop(appointment_id, None)
+            self.by_user.setdefault(appointment.user_id, {})[appointment_id] = None
         return appointment
 
     def log_cancellation_reason(self, appointment_id: str, reason: str) -> bool:
@@ -67,10 +87,96 @@ class HealthAssistant:
         return True
 
     def delete_appointment(self, appointment_id: str) -> bool:
-        if appointment_id not in self.appointments:
+        appointment = self.appointments.pop(appointment_id, None)
+        if appointment is None:
             return False
-        del self.appointments[appointment_id]
+        self.by_user.get(appointment.user_id, {}).pop(appointment_id, None)
         return True
         
     def get_appointments(self, user_id: str) -> List[Appointment]:
-        return [appt for appt in self.appointments.values() if appt.user_id == user_id]
\ No newline at end of file
+        return [self.appointments[appt_id] for appt_id in self.by_user.get(user_id, ())]
+
+class SQLHealthAssistant:
+    """HealthAssistant backed by a SQL database, so state is shared across workers and survives restarts"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def save_conversation(self, user_id: str, role: str, content: str):
+        with self.engine.begin() as conn:
+            conn.execute(insert(db.conversations).values(
+                user_id=user_id, ts=datetime.now(), role=role, content=content
+            ))
+
+    def get_conversation(self, user_id: str) -> List:
+        query = (
+            select(db.conversations.c.role, db.conversations.c.content)
+            .where(db.conversations.c.user_id == user_id)
+            .order_by(db.conversations.c.id.desc())
+            .limit(MAX_HISTORY_MESSAGES)
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).all()
+        return [_to_message(role, content) for role, content in reversed(rows)]
+
+    def create_appointment(self, user_id: str, date_time: datetime, purpose: str, email: str = None) -> Appointment:
+        appointment = Appointment(user_id=user_id, date_time=date_time, purpose=purpose, email=email)
+        with self.engine.begin() as conn:
+            conn.execute(insert(db.appointments).values(**appointment.to_dict()))
+        return appointment
+
+    def get_appointment(self, appointment_id: str) -> Optional[Appointment]:
+        with self.engine.connect() as conn:
+            row = conn.execute(select(db.appointments).where(db.appointments.c.id == appointment_id)).first()
+        return Appointment.from_dict(row._mapping) if row else None
+
+    def is_owner(self, user_id: str, appointment_id: str) -> bool:
+        query = select(db.appointments.c.id).where(
+            db.appointments.c.id == appointment_id, db.appointments.c.user_id == user_id
+        )
+        with self.engine.connect() as conn:
+            return conn.execute(query).first() is not None
+
+    def update_appointment(self, appointment_id: str, **kwargs) -> Optional[Appointment]:
+        if not kwargs:
+            return self.get_appointment(appointment_id)
+        statement = update(db.appointments).where(db.appointments.c.id == appointment_id).values(**kwargs)
+        if self.engine.dialect.update_returning:
+            # Write and read back the updated row in a single round trip
+            with self.engine.begin() as conn:
+                row = conn.execute(statement.returning(*db.appointments.c)).first()
+            return Appointment.from_dict(row._mapping) if row else None
+        with self.engine.begin() as conn:
+            if conn.execute(statement).rowcount == 0:
+                return None
+            row = conn.execute(select(db.appointments).where(db.appointments.c.id == appointment_id)).first()
+        return Appointment.from_dict(row._mapping)
+
+    def log_cancellation_reason(self, appointment_id: str, reason: str) -> bool:
+        with self.engine.begin() as conn:
+            conn.execute(delete(db.cancellations).where(db.cancellations.c.appointment_id == appointment_id))
+            conn.execute(insert(db.cancellations).values(
+                appointment_id=appointment_id, reason=reason, timestamp=datetime.now()
+            ))
+        return True
+
+    def delete_appointment(self, appointment_id: str) -> bool:
+        with self.engine.begin() as conn:
+            result = conn.execute(delete(db.appointments).where(db.appointments.c.id == appointment_id))
+        return result.rowcount > 0
+
+    def get_appointments(self, user_id: str) -> List[Appointment]:
+        query = (
+            select(db.appointments)
+            .where(db.appointments.c.user_id == user_id)
+            .order_by(db.appointments.c.date_time)
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).all()
+        return [Appointment.from_dict(row._mapping) for row in rows]
+
+def create_health_assistant():
+    """Use the SQL store when DATABASE_URL is configured, otherwise keep state in memory"""
+    if db.DATABASE_URL:
+        return SQLHealthAssistant(db.create_db_engine(db.DATABASE_URL))
+    return HealthAssistant()
@@ -1,9 +1,321 @@
-from datetime import datetime, timedelta
-from dateutil import parser
+from datetime import date, datetime, timedelta
 import os
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import smtplib
+from types import SimpleNamespace
+from typing import Optional
+import functools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# SMTP settings never change during the process, so read them once at import
+_SMTP_USE_SSL = os.getenv("SMTP_USE_SSL", "").lower() in ("1", "true", "yes")
+_SMTP_CONFIG = SimpleNamespace(
+    # Email credentials
+    sender=os.getenv("EMAIL_SENDER"),
+    password=os.getenv("SMTP_PASSWORD"),  # Use App Password if using Gmail
+    # SMTP server configuration (Gmail example)
+    host=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+    port=int(os.getenv("SMTP_PORT", 465 if _SMTP_USE_SSL else 587)),
+)
+# Implicit TLS (SMTPS) skips the plaintext EHLO + STARTTLS exchange before login
+_SMTP_CONFIG.use_ssl = _SMTP_USE_SSL or _SMTP_CONFIG.port == 465
+if not (_SMTP_CONFIG.sender and _SMTP_CONFIG.password):
+    log.warning("EMAIL_SENDER and SMTP_PASSWORD are not set; email notifications will fail")
+
+# The email/SMTP stack and dateutil are imported on first use, so importing utils
+# for unrelated helpers doesn't pay for them
+
+
+@functools.cache
+def _email_policy():
+    from email import policy
+    # CRLF line endings and a 7-bit safe body (non-ASCII text gets quoted-printable/base64)
+    return policy.SMTP.clone(cte_type="7bit")
+
+
+@functools.cache
+def _dateutil_parser():
+    from dateutil import parser
+    return parser
+
+
+@functools.cache
+def _ssl_context():
+    import ssl
+    # One context (CA store, ciphers, session cache) shared by every SMTP connection
+    return ssl.create_default_context()
+
+
+def _build_message(sender_email, to_email, subject, body):
+    from email.message import EmailMessage
+    # Create email message (a single text/plain part; no multipart wrapper or boundary needed)
+    msg = EmailMessage(policy=_email_policy())
+    msg["From"] = sender_email
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg.set_content(body)
+    return msg
+
+
+# Recycle bulk-send connections periodically; many providers throttle long-lived sessions
+MESSAGES_PER_CONNECTION = 100
+
+# Only health-check a connection that has sat idle this long; a recently used one is trusted, and
+# a drop is still caught by the reconnect-and-retry in _deliver_with_retry
+IDLE_CHECK_SECONDS = 30
+
+
+# Stand-in recipient for templated bulk sends; replaced per recipient in the rendered bytes
+_TEMPLATE_RECIPIENT = "recipient@template.invalid"
+_TEMPLATE_TO_HEADER = f"To: {_TEMPLATE_RECIPIENT}\r\n".encode("ascii")
+
+_LEADING_DOT_RE = re.compile(rb"(?m)^\.")
+
+_EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+
+def is_valid_email(email):
+    """Check an address's syntax in-process, before any SMTP round-trip."""
+    return _EMAIL_RE.fullmatch(email) is not None
+
+
+def _address_template(template, to_email):
+    return template.replace(_TEMPLATE_TO_HEADER, f"To: {to_email}\r\n".encode("ascii"), 1)
+
+
+class SMTPMailer:
+    """
+    Send emails over one persistent SMTP connection.
+    
+    The connection is opened on first use and reused for later emails, so the
+    TCP + STARTTLS + AUTH handshake is paid once instead of per email. A dropped
+    connection is re-established and the send retried once.
+    """
+
+    def __init__(self, config=_SMTP_CONFIG):
+        self.config = config
+        self.server = None
+        self.last_used = 0.0  # time.monotonic() of the last successful command on the connection
+        self.lock = threading.Lock()  # smtplib.SMTP is not thread-safe
+
+    def _connect(self):
+        import smtplib
+        self.close()
+        if self.config.use_ssl:
+            server = smtplib.SMTP_SSL(self.config.host, self.config.port, context=_ssl_context())
+        else:
+            server = smtplib.SMTP(self.config.host, self.config.port)
+        try:
+            if not self.config.use_ssl:
+                server.starttls(context=_ssl_context())  # Secure connection
+            server.login(self.config.sender, self.config.password)
+        except BaseException:
+            server.close()  # Don't leak the socket when the handshake or login fails
+            raise
+        self.server = server
+        self.last_used = time.monotonic()
+
+    def _ensure_connected(self):
+        if self.server is None:
+            self._connect()
+            return
+        if time.monotonic() - self.last_used < IDLE_CHECK_SECONDS:
+            return
+        try:
+            # Health check: the server may have dropped an idle connection
+            if self.server.noop()[0] != 250:
+                self._connect()
+        except OSError:  # Includes smtplib.SMTPException
+            self._connect()
+
+    def _deliver_with_retry(self, to_email, data):
+        import smtplib
+        if self.server is None:
+            self._connect()
+        try:
+            self._deliver(to_email, data)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+            self._connect()
+            self._deliver(to_email, data)
+        self.last_used = time.monotonic()
+
+    def _deliver(self, to_email, data):
+        # data is the serialized message (CRLF line endings, 7-bit) from _build_message(...).as_bytes()
+        if "pipelining" in self.server.esmtp_features:
+            self._pipelined_sendmail(to_email, data)
+        else:
+            self.server.sendmail(self.config.sender, to_email, data)
+
+    def _pipelined_sendmail(self, to_email, data):
+        import smtplib
+        # The server advertised PIPELINING (RFC 2920): send MAIL, RCPT and DATA in one
+        # write and read the three replies afterwards, instead of one round trip each
+        server = self.server
+        server.send(
+            f"MAIL FROM:{smtplib.quoteaddr(self.config.sender)}\r\n"
+            f"RCPT TO:{smtplib.quoteaddr(to_email)}\r\n"
+            "DATA\r\n"
+        )
+        (mail_code, mail_resp), (rcpt_code, rcpt_resp), (data_code, data_resp) = (
+            server.getreply(), server.getreply(), server.getreply()
+        )
+        if data_code == 354 and (mail_code != 250 or rcpt_code not in (250, 251)):
+            # Should not happen, but never leave the server waiting for message content
+            server.send(".\r\n")
+            server.getreply()
+        if mail_code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, self.config.sender)
+        if rcpt_code not in (250, 251):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused({to_email: (rcpt_code, rcpt_resp)})
+        if data_code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        
+        content = _LEADING_DOT_RE.sub(b"..", data)  # Dot-stuffing (RFC 5321 4.5.2)
+        if not content.endswith(b"\r\n"):
+            content += b"\r\n"
+        server.send(content + b".\r\n")
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def send(self, to_email, subject, body):
+        import smtplib
+        if not is_valid_email(to_email):
+            log.warning("Not sending email to invalid address %r", to_email)
+            return False
+        try:
+            data = _build_message(self.config.sender, to_email, subject, body).as_bytes()
+        except ValueError:
+            # e.g. a CR/LF in a header value, which would otherwise allow header injection
+            log.exception("Could not build email to %s", to_email)
+            return False
+        
+        with self.lock:
+            try:
+                self._ensure_connected()
+                self._deliver_with_retry(to_email, data)
+                log.info("Email sent to %s", to_email)
+                return True
+            except smtplib.SMTPAuthenticationError:
+                log.exception("SMTP authentication failed; check EMAIL_SENDER and SMTP_PASSWORD")
+            except smtplib.SMTPRecipientsRefused:
+                log.exception("SMTP server refused recipient %s", to_email)
+            except smtplib.SMTPServerDisconnected:
+                log.exception("SMTP connection failed while sending to %s", to_email)
+                self.close()
+            except smtplib.SMTPException:
+                log.exception("Error sending email to %s", to_email)
+                self.close()  # The session may be mid-transaction; start fresh next time
+            except OSError:
+                # Socket/TLS errors; checked last because SMTPException subclasses OSError
+                log.exception("SMTP connection failed while sending to %s", to_email)
+                self.close()
+            return False
+
+    def send_bulk(self, messages, batch_fail_ratio=1/3):
+        """
+        Send many emails over one session instead of reconnecting per email.
+        
+        Per-message failures are recorded without tearing down the session. For
+        batches of 30 or more, sending stops once failures exceed batch_fail_ratio.
+        The connection is recycled every MESSAGES_PER_CONNECTION emails.
+        
+        Parameters:
+        messages (list): (to_email, subject, body) tuples
+        batch_fail_ratio (float): Fraction of failures that aborts a large batch
+        
+        Returns:
+        list: (to_email, ok, error) tuples, one per message, in order
+        """
+        envelopes = [
+            (to_email, functools.partial(self._render, to_email, subject, body))
+            for to_email, subject, body in messages
+        ]
+        return self._send_batch(envelopes, batch_fail_ratio)
+
+    def send_templated_bulk(self, subject, body, to_list, batch_fail_ratio=1/3):
+        """
+        Send the same email to many recipients, serializing the message only once.
+        
+        Only the To header differs per recipient, so it is spliced into the
+        pre-rendered bytes instead of rebuilding and re-encoding the message.
+        
+        Parameters:
+        subject (str): Email subject
+        body (str): Email content shared by all recipients
+        to_list (list): Recipients' email addresses
+        batch_fail_ratio (float): Fraction of failures that aborts a large batch
+        
+        Returns:
+        list: (to_email, ok, error) tuples, one per recipient, in order
+        """
+        try:
+            template = _build_message(self.config.sender, _TEMPLATE_RECIPIENT, subject, body).as_bytes()
+        except ValueError as e:
+            log.warning("Could not build bulk email: %s", e)
+            return [(to_email, False, str(e)) for to_email in to_list]
+        envelopes = [
+            (to_email, functools.partial(_address_template, template, to_email))
+            for to_email in to_list
+        ]
+        return self._send_batch(envelopes, batch_fail_ratio)
+
+    def _render(self, to_email, subject, body):
+        return _build_message(self.config.sender, to_email, subject, body).as_bytes()
+
+    def _send_batch(self, envelopes, batch_fail_ratio):
+        # envelopes: (to_email, render) pairs; render() returns the message bytes
+        results = []
+        failed = 0
+        with self.lock:
+            for index, (to_email, render) in enumerate(envelopes):
+                if failed > len(envelopes) * batch_fail_ratio and len(envelopes) >= 30:
+                    results.append((to_email, False, "Batch aborted after too many failures"))
+                    continue
+                if not is_valid_email(to_email):
+                    log.warning("Bulk send skipped invalid address %r", to_email)
+                    failed += 1
+                    results.append((to_email, False, "Invalid email address"))
+                    continue
+                try:
+                    if index == 0:
+                        self._ensure_connected()
+                    elif index % MESSAGES_PER_CONNECTION == 0:
+                        self._connect()
+                    self._deliver_with_retry(to_email, render())
+                    results.append((to_email, True, None))
+                except (OSError, ValueError) as e:  # OSError includes smtplib.SMTPException
+                    log.warning("Bulk send to %s failed: %s", to_email, e)
+                    failed += 1
+                    results.append((to_email, False, str(e)))
+        sent = sum(1 for _, ok, _ in results if ok)
+        log.info("Bulk send finished: %d/%d emails sent", sent, len(envelopes))
+        return results
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except OSError:  # Includes smtplib.SMTPException
+            pass
+        self.server = None
+
+
+mailer = SMTPMailer()
+atexit.register(mailer.close)
+
 
 def send_email(to_email, subject, body):
     """
@@ -17,43 +329,176 @@ def send_email(to_email, subject, body):
     Returns:
     bool: True if email was sent successfully, False otherwise
     """
-    # Email credentials
-    sender_email = os.getenv("EMAIL_SENDER")
-    sender_password = os.getenv("SMTP_PASSWORD")  # Use App Password if using Gmail
-    receiver_email = to_email
+    return mailer.send(to_email, subject, body)
+
+
+
+def send_bulk(messages, batch_fail_ratio=1/3):
+    """
+    Send many emails over one SMTP session. See SMTPMailer.send_bulk.
     
-    # Create email message
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = receiver_email
-    msg["Subject"] = subject
-    msg.attach(MIMEText(body, "plain"))
+    Parameters:
+    messages (list): (to_email, subject, body) tuples
     
-    # SMTP server configuration (Gmail example)
-    smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-    smtp_port = int(os.getenv("SMTP_PORT", 587))
+    Returns:
+    list: (to_email, ok, error) tuples, one per message
+    """
+    return mailer.send_bulk(messages, batch_fail_ratio)
+
+
+def send_templated_bulk(subject, body, to_list, batch_fail_ratio=1/3):
+    """
+    Send one email to many recipients over one SMTP session. See SMTPMailer.send_templated_bulk.
+    
+    Parameters:
+    subject (str): Email subject
+    body (str): Email content
+    to_list (list): Recipients' email addresses
+    
+    Returns:
+    list: (to_email, ok, error) tuples, one per recipient
+    """
+    return mailer.send_templated_bulk(subject, body, to_list, batch_fail_ratio)
+
+
+# Background senders for fire-and-forget emails; they share the mailer's connection under its lock
+_EMAIL_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("EMAIL_WORKERS", 4)), thread_name_prefix="smtp")
+atexit.register(_EMAIL_POOL.shutdown, wait=True)
+
+
+def enqueue_email(to_email, subject, body):
+    """
+    Queue an email to be sent on a background thread and return immediately.
+    
+    Returns:
+    Future: Resolves to send_email's result (True if the email was sent)
+    """
+    return _EMAIL_POOL.submit(send_email, to_email, subject, body)
+
+
+async def send_email_async(to_email, subject, body):
+    """
+    Send an email using SMTP without blocking the event loop.
+    
+    Each call uses its own connection, so several sends can run concurrently
+    with asyncio.gather (for example to different servers).
+    
+    Parameters:
+    to_email (str): Recipient's email address
+    subject (str): Email subject
+    body (str): Email content
     
+    Returns:
+    bool: True if email was sent successfully, False otherwise
+    """
+    import aiosmtplib
+    if not is_valid_email(to_email):
+        log.warning("Not sending email to invalid address %r", to_email)
+        return False
     try:
-        # Connect to SMTP server and send email
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()  # Secure connection
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
-        server.quit()
-        print(f"Email sent successfully to {to_email}!")
+        msg = _build_message(_SMTP_CONFIG.sender, to_email, subject, body)
+        async with aiosmtplib.SMTP(
+            hostname=_SMTP_CONFIG.host, port=_SMTP_CONFIG.port, use_tls=_SMTP_CONFIG.use_ssl, start_tls=False,
+            tls_context=_ssl_context(),
+        ) as client:
+            if not _SMTP_CONFIG.use_ssl:
+                await client.starttls(tls_context=_ssl_context())  # Secure connection
+            await client.login(_SMTP_CONFIG.sender, _SMTP_CONFIG.password)
+            await client.send_message(msg)
+        log.info("Email sent to %s", to_email)
         return True
-    except Exception as e:
-        print(f"Error sending email: {e}")
+    except (aiosmtplib.SMTPException, OSError, ValueError):
+        log.exception("Error sending email to %s", to_email)
         return False
 
 
+# Tried in order before falling back to dateutil
+_FAST_FORMATS = (
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%m/%d/%Y",
+    "%d %b %Y",
+    "%d %B %Y",
+)
+
+
+_RELATIVE_OFFSETS = {
+    "today": timedelta(0),
+    "tomorrow": timedelta(days=1),
+    "yesterday": timedelta(days=-1),
+    "next week": timedelta(days=7),
+}
+_RELATIVE_DATE_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, _RELATIVE_OFFSETS)) + r")\b", re.IGNORECASE
+)
+
+
+def _parse_date(text: str, default: datetime) -> datetime:
+    # Common exact formats are much cheaper to try with strptime than a full dateutil parse;
+    # the loop's globals are bound to locals to skip repeated global/attribute lookups
+    strptime, value_error = datetime.strptime, ValueError
+    for fmt in _FAST_FORMATS:
+        try:
+            return strptime(text, fmt)
+        except value_error:
+            continue
+    return _dateutil_parser().parse(text, default=default)
+
+
+# Failures are cached as None too, so resubmitting the same unparseable text skips the full dateutil attempt
+@functools.lru_cache(maxsize=4096)
+def _try_parse_natural_date(text: str, today_ordinal: int) -> Optional[datetime]:
+    # Missing fields default to midnight of the base day (dateutil's own default),
+    # so the result depends only on the text and today's date and is safe to cache
+    today = datetime.fromordinal(today_ordinal)
+    try:
+        # Handle relative dates: shift the base day and parse whatever remains around the keyword
+        match = _RELATIVE_DATE_RE.search(text)
+        if match:
+            base_date = today + _RELATIVE_OFFSETS[match.group(0).lower()]
+            remainder = f"{text[:match.start()]} {text[match.end():]}".strip()
+            return _dateutil_parser().parse(remainder, default=base_date) if remainder else base_date
+        return _parse_date(text, today)
+    except (ValueError, OverflowError):
+        return None
+
+
 def parse_natural_date(text: str) -> datetime:
+    parsed = _try_parse_natural_date(text, date.today().toordinal())
+    if parsed is None:
+        raise ValueError(f"Could not parse date: {text!r}")
+    return parsed
+
+
+@functools.lru_cache(maxsize=4096)
+def _try_parse_absolute_date(text: str) -> Optional[datetime]:
+    # Parse against two different default days: if the results differ, the text
+    # left part of the date unspecified and the answer would depend on today
     try:
-        # Handle relative dates
-        now = datetime.now()
-        if "tomorrow" in text.lower():
-            base_date = now + timedelta(days=1)
-            return parser.parse(text, default=base_date)
-        return parser.parse(text)
-    except Exception as e:
-        raise ValueError(f"Could not parse date: {str(e)}")
\ No newline at end of file
+        parsed = _parse_date(text, datetime(2000, 1, 1))
+        if parsed != _parse_date(text, datetime(2001, 2, 2)):
+            return None
+        return parsed
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_absolute_date(text: str) -> datetime:
+    """
+    Parse a fully specified date (year, month and day present).
+    
+    Unlike parse_natural_date, the result never depends on the current day, so
+    it is cached on the text alone and stays valid across midnight.
+    
+    Parameters:
+    text (str): Date string such as "2025-03-04 10:30" or "4 March 2025"
+    
+    Returns:
+    datetime: The parsed date; raises ValueError if it is relative or incomplete
+    """
+    parsed = _try_parse_absolute_date(text)
+    if parsed is None:
+        raise ValueError(f"Could not parse date or date is incomplete: {text!r}")
+    return parsed